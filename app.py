@@ -1,21 +1,52 @@
 # app.py
+import asyncio
+import gzip
+import json
 import os
+import threading
+from collections import OrderedDict
+
 import chromadb
-from fastapi import FastAPI, Depends, HTTPException
+import numpy as np
+import torch
+from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
-from fastapi.responses import HTMLResponse
-from openai import OpenAI
+from fastapi.responses import Response, StreamingResponse
+from openai import AsyncOpenAI
 from sentence_transformers import CrossEncoder
+from encoder import MAX_LENGTH, load_encoder
+torch.set_num_threads(int(os.getenv("TORCH_THREADS", os.cpu_count() or 1)))
+torch.set_num_interop_threads(2)
 reranker = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")  # fast & good
+# BF16 weights where the CPU has native AVX-512 BF16 (Sapphire Rapids, Zen 4); scores are cast back to FP32
+if getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)():
+    reranker.model = reranker.model.to(torch.bfloat16)
 RERANK_TOP_K = 5
-oai = OpenAI(api_key=os.getenv("OPEN_API_KEY"))
+oai = AsyncOpenAI(api_key=os.getenv("OPEN_API_KEY"))
 
 client = chromadb.PersistentClient(path="./chroma")  # must match ingest path
 SPACE_KEY = os.getenv("CONF_SPACE", "SD")
-col = client.get_or_create_collection(f"confluence_{SPACE_KEY}")
-embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+# HNSW params must match ingest_index.py (they're fixed when the collection is created)
+col = client.get_or_create_collection(
+    name=f"confluence_{SPACE_KEY}",
+    metadata={"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:construction_ef": 128, "hnsw:search_ef": 80},
+)
+encoder = load_encoder()
+
+# all-MiniLM-L6-v2 and the ms-marco MiniLM cross-encoder share the uncased BERT WordPiece vocab,
+# so the question is tokenized once per request and its ids feed both models
+tok = encoder.tokenizer
+if tok.get_vocab() != reranker.tokenizer.get_vocab():
+    raise RuntimeError("embedder and reranker vocabularies differ; token ids can't be shared")
+RERANK_MAX_LENGTH = 512
+
+# Query-embedding cache: exact LRU on the normalized question, plus a
+# near-duplicate check against recent vectors (all L2-normalized, so dot == cosine)
+QCACHE_SIZE = 1024
+CACHE_SIM_THRESHOLD = float(os.getenv("CACHE_SIM_THRESHOLD", "0.97"))
+_qcache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_qcache_lock = threading.Lock()
 
 app = FastAPI(title="Confluence QA")
 app.add_middleware(
@@ -40,20 +71,42 @@ SYSTEM_PROMPT = (
 
 def build_context_blocks(docs, metas, max_chars=5500):
     """Pack top chunks until we hit a safe context size."""
-    blocks, cites = [], []
-    used = 0
-    for d, m in zip(docs, metas):
-        snippet = d.strip()
-        title = m.get("title", "Untitled")
-        url = m.get("url")
-        block = f"Title: {title}\nURL: {url}\nContent:\n{snippet}\n---\n"
-        if used + len(block) > max_chars:
-            break
-        blocks.append(block)
-        cites.append({"title": title, "url": url})
-        used += len(block)
-    return "\n".join(blocks), cites
-
+    # Blocks are preformatted at ingest; format here only for chunks indexed before that
+    blocks = [m.get("block") or f"Title: {m.get('title', 'Untitled')}\nURL: {m.get('url')}\nContent:\n{d.strip()}\n---\n"
+              for d, m in zip(docs, metas)]
+    lens = np.fromiter((len(b) for b in blocks), dtype=np.int64, count=len(blocks))
+    cut = int(np.searchsorted(np.cumsum(lens), max_chars, side="right"))
+    cites = [{"title": m.get("title", "Untitled"), "url": m.get("url")} for m in metas[:cut]]
+    # Relevance picks the set; a stable (page_id, text) order makes the same set produce a
+    # byte-identical context, so the prompt prefix hits OpenAI's prompt cache
+    kept = sorted(zip(blocks[:cut], metas[:cut]), key=lambda bm: (str(bm[1].get("page_id", "")), bm[0]))
+    return "\n".join(b for b, _ in kept), cites
+
+
+
+def _pair_inputs(q_ids, d_ids):
+    """[CLS] q [SEP] d [SEP] with segment ids; the doc side is truncated to fit RERANK_MAX_LENGTH."""
+    q_ids = q_ids[:RERANK_MAX_LENGTH // 2]
+    d_ids = d_ids[:RERANK_MAX_LENGTH - len(q_ids) - 3]
+    return {"input_ids": [tok.cls_token_id, *q_ids, tok.sep_token_id, *d_ids, tok.sep_token_id],
+            "token_type_ids": [0] * (len(q_ids) + 2) + [1] * (len(d_ids) + 1)}
+
+
+def rerank(q_ids, docs, metas, top_k=RERANK_TOP_K):
+    """Cross-encoder rerank from pre-tokenized ids; pairs are length-sorted so each batch pads to similar lengths."""
+    d_ids = tok(docs, add_special_tokens=False)["input_ids"]
+    order = sorted(range(len(docs)), key=lambda i: len(d_ids[i]))
+    feats = [_pair_inputs(q_ids, d_ids[i]) for i in order]
+    scores_sorted = np.empty(len(feats), dtype=np.float32)
+    for b in range(0, len(feats), 32):
+        batch = tok.pad(feats[b:b + 32], return_tensors="pt")
+        with torch.inference_mode():
+            logits = reranker.model(**batch).logits
+        scores_sorted[b:b + len(logits)] = logits[:, 0].float().numpy()  # raw logits: same order as predict()
+    scores = np.empty_like(scores_sorted)
+    scores[order] = scores_sorted
+    top = np.argsort(-scores)[:top_k]
+    return [docs[i] for i in top], [metas[i] for i in top]
 
 
 def security_filter(metas, user_email):
@@ -61,21 +114,94 @@ def security_filter(metas, user_email):
     return [m for m in metas]  # replace with real checks
 
 
-with open("index.html", "r", encoding="utf-8") as f:
-    INDEX_HTML = f.read()
+def embed_query(question: str, q_ids) -> np.ndarray:
+    """Encode a question, reusing cached vectors for repeated or near-duplicate questions."""
+    key = question.strip().lower()
+    with _qcache_lock:
+        vec = _qcache.get(key)
+        if vec is not None:
+            _qcache.move_to_end(key)
+            return vec
+        mat = np.stack(list(_qcache.values())) if _qcache else None
+
+    vec = encoder.encode_ids([[tok.cls_token_id, *q_ids[:MAX_LENGTH - 2], tok.sep_token_id]])[0]
+    if mat is not None:
+        sims = mat @ vec
+        best = int(np.argmax(sims))
+        if sims[best] > CACHE_SIM_THRESHOLD:
+            vec = mat[best]  # near-duplicate: share its vector so retrieval stays identical
+
+    with _qcache_lock:
+        _qcache[key] = vec
+        _qcache.move_to_end(key)
+        if len(_qcache) > QCACHE_SIZE:
+            _qcache.popitem(last=False)
+    return vec
 
 
+# Static page: bytes and gzip'd bytes are prepared once. A fresh (cheap) Response is still built per
+# request because middleware such as CORS appends to a response's header list in place.
+with open("index.html", "rb") as f:
+    INDEX_BODY = f.read()
+INDEX_BODY_GZ = gzip.compress(INDEX_BODY, compresslevel=9)
+INDEX_HEADERS = {"cache-control": "public, max-age=300", "vary": "Accept-Encoding"}
+
 
 @app.get("/", include_in_schema=False)
-def root():
-    return HTMLResponse(INDEX_HTML)
+def root(request: Request):
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(INDEX_BODY_GZ, media_type="text/html",
+                        headers={**INDEX_HEADERS, "content-encoding": "gzip"})
+    return Response(INDEX_BODY, media_type="text/html", headers=INDEX_HEADERS)
+
+def build_user_prompt(context_text, question):
+    # Context first, question last: keeps the long shared part as the prefix
+    return (
+        f"CONTEXT (Confluence excerpts, newest to oldest may vary):\n{context_text}\n"
+        f"QUESTION:\n{question}\n\n"
+        "Return a concise answer followed by a bullet list of citations."
+    )
+
+
+async def open_llm_stream(user_prompt):
+    return await oai.responses.create(
+        model=os.getenv("OAI_MODEL", "gpt-4o-mini"),
+        input=[
+            {
+                "role": "system",
+                "content": [
+                    {"type": "input_text", "text": SYSTEM_PROMPT}
+                ],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": user_prompt}
+                ],
+            },
+        ],
+        max_output_tokens=600,
+        stream=True,
+    )
+
+
+async def discard_stream(task):
+    """Cancel a speculative LLM call, closing its stream if it already opened."""
+    task.cancel()
+    try:
+        stream = await task
+    except (asyncio.CancelledError, Exception):
+        return
+    await stream.close()
+
 
 @app.post("/ask")
-def ask(q: Query):
-    # 1) retrieve
-    qvec = embedder.encode([q.question], normalize_embeddings=True)[0].tolist()
-    res = col.query(query_embeddings=[qvec], n_results=q.k,
-                    include=["metadatas", "documents", "distances"])
+async def ask(q: Query):
+    # 1) retrieve (encoder, Chroma and reranker are blocking, so keep them off the event loop)
+    q_ids = tok(q.question, add_special_tokens=False)["input_ids"]
+    qvec = await asyncio.to_thread(embed_query, q.question, q_ids)
+    res = await asyncio.to_thread(col.query, query_embeddings=np.asarray([qvec], dtype=np.float32),
+                                  n_results=q.k, include=["metadatas", "documents"])
 
     metas = [m for sub in res["metadatas"] for m in sub]
     docs  = [d for sub in res["documents"] for d in sub]
@@ -83,39 +209,40 @@ def ask(q: Query):
     if not docs:
         raise HTTPException(status_code=404, detail="No relevant content found.")
 
+    # 2) speculatively start the LLM on the top vector hits while the reranker runs;
+    # keep it only if reranking packs exactly the same context (block order is canonical)
+    spec_context, _ = build_context_blocks(docs[:RERANK_TOP_K], metas[:RERANK_TOP_K])
+    spec = asyncio.create_task(open_llm_stream(build_user_prompt(spec_context, q.question)))
+    try:
+        docs, metas = await asyncio.to_thread(rerank, q_ids, docs, metas)
+    except Exception:
+        await discard_stream(spec)
+        raise
     context_text, cites = build_context_blocks(docs, metas)
 
-    # 2) craft prompt
-    user_prompt = (
-        f"QUESTION:\n{q.question}\n\n"
-        f"CONTEXT (Confluence excerpts, newest to oldest may vary):\n{context_text}\n"
-        "Return a concise answer followed by a bullet list of citations."
-    )
+    if context_text == spec_context:
+        llm = spec
+    else:
+        await discard_stream(spec)
+        llm = asyncio.create_task(open_llm_stream(build_user_prompt(context_text, q.question)))
 
-    # 3) call OpenAI (Responses API)
+    # 3) OpenAI (Responses API, streamed)
     try:
-        resp = oai.responses.create(
-            model=os.getenv("OAI_MODEL", "gpt-4o-mini"),
-            input=[
-                {
-                    "role": "system",
-                    "content": [
-                        {"type": "input_text", "text": SYSTEM_PROMPT}
-                    ],
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": user_prompt}
-                    ],
-                },
-            ],
-            max_output_tokens=600,
-        )
-        answer_text = resp.output_text
+        stream = await llm
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM error: {e}")
-    
 
-    return {"answer": answer_text, "sources": cites[:5]}
-# new
+    # NDJSON: one {"sources": [...]} line, then {"delta": "..."} lines as tokens arrive
+    async def events():
+        try:
+            yield json.dumps({"sources": cites[:5]}) + "\n"
+            async for ev in stream:
+                if ev.type == "response.output_text.delta":
+                    yield json.dumps({"delta": ev.delta}) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": f"LLM error: {e}"}) + "\n"
+        finally:
+            # Release the upstream connection on completion, errors and client disconnects
+            await stream.close()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
@@ -0,0 +1,98 @@
+# encoder.py
+import os
+from typing import List
+
+import numpy as np
+import onnxruntime as ort
+from transformers import AutoTokenizer
+
+MODEL_NAME  = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_PATH   = os.getenv("ONNX_PATH", "minilm.onnx")
+INT8_PATH   = os.getenv("ONNX_INT8_PATH", "minilm.int8.onnx")
+USE_INT8    = os.getenv("EMBED_INT8", "false").lower() in ("1", "true", "yes")
+MAX_LENGTH  = 256  # matches SentenceTransformer's max_seq_length for MiniLM
+
+
+def export_onnx(path: str = ONNX_PATH, int8_path: str = INT8_PATH, model_name: str = MODEL_NAME) -> None:
+    """Export MiniLM to ONNX with dynamic batch/seq axes, plus an INT8 dynamic-quantized copy."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel
+
+    class _Encoder(torch.nn.Module):
+        # Keyword-only call into the HF model; positional tracing collides with its other forward() args
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask,
+                              token_type_ids=token_type_ids).last_hidden_state
+
+    tok = AutoTokenizer.from_pretrained(model_name)
+    model = _Encoder(AutoModel.from_pretrained(model_name)).eval()
+    sample = tok(["export"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    axes = {0: "batch", 1: "seq"}
+
+    torch.onnx.export(
+        model,
+        tuple(sample[n] for n in names),
+        path,
+        input_names=names,
+        output_names=["last_hidden_state"],
+        dynamic_axes={**{n: axes for n in names}, "last_hidden_state": axes},
+        opset_version=14,
+        dynamo=False,  # TorchScript exporter; the dynamo one needs onnxscript
+    )
+    quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+    print(f"[onnx] wrote {path} and {int8_path}")
+
+
+class OnnxEncoder:
+    """MiniLM sentence encoder on ONNX Runtime: mean-pooled, L2-normalized float32 vectors."""
+
+    def __init__(self, path: str, model_name: str = MODEL_NAME):
+        self.path = path
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        so.intra_op_num_threads = os.cpu_count() or 1
+        self.session = ort.InferenceSession(path, sess_options=so, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.dim = self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                 max_length=MAX_LENGTH, return_tensors="np")
+            out[i:i + len(enc["input_ids"])] = self._forward(enc)
+        return out
+
+    def encode_ids(self, input_ids: List[List[int]]) -> np.ndarray:
+        """Encode inputs the caller already tokenized (special tokens included, <= MAX_LENGTH)."""
+        return self._forward(self.tokenizer.pad({"input_ids": input_ids}, return_tensors="np"))
+
+    def _forward(self, enc) -> np.ndarray:
+        ids = enc["input_ids"]
+        feed = {n: (enc[n] if n in enc else np.zeros_like(ids)).astype(np.int64) for n in self.input_names}
+        hidden = self.session.run(None, feed)[0]
+
+        # Mean-pool over real tokens, then L2-normalize
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        v = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def load_encoder() -> OnnxEncoder:
+    """Load the FP32 or INT8 model (EMBED_INT8); export them beforehand with `python encoder.py`."""
+    path = INT8_PATH if USE_INT8 else ONNX_PATH
+    if not os.path.exists(path):
+        # No export here: several API workers starting at once would race writing the same files
+        raise SystemExit(f"[error] ONNX model {path} not found; run `python encoder.py` first.")
+    return OnnxEncoder(path)
+
+
+if __name__ == "__main__":
+    export_onnx()
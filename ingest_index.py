@@ -1,15 +1,20 @@
 # ingest_index.py
+import argparse
+import asyncio
 import os
 import re
-import time
-import hashlib
-from typing import Iterable, List
+import sqlite3
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Tuple
 
 import chromadb
-from atlassian import Confluence
+import httpx
+from blake3 import blake3
+import numpy as np
 from bs4 import BeautifulSoup
-from markdownify import markdownify as md
-from sentence_transformers import SentenceTransformer
+from markdownify import MarkdownConverter
+
+from encoder import load_encoder
 
 # ========= Env / Config =========
 CONF_URL    = os.getenv("CONF_URL")             # e.g. https://<site>.atlassian.net/wiki
@@ -17,12 +22,18 @@ CONF_USER   = os.getenv("CONF_USER")            # Atlassian email (Cloud)
 CONF_TOKEN  = os.getenv("CONF_TOKEN")           # API token: id.atlassian.com
 SPACE_KEY   = os.getenv("CONF_SPACE", "ENG")
 CHROMA_PATH = os.getenv("CHROMA_PATH", "./chroma")
+EMB_CACHE   = os.getenv("EMB_CACHE", "./emb_cache.db")  # per-model sha1(chunk) -> float32 vector
 COLLECTION  = f"confluence_{SPACE_KEY}"
 
 # Chunking knobs
 MAX_CHARS = 1800
 OVERLAP   = 220
 BATCH_EMB = 64
+UPSERT_BATCH = 10_000  # rows per upsert, bounds sqlite WAL growth
+FETCH_CONCURRENCY = 8  # in-flight Confluence page requests
+
+# HNSW index params (cosine: embeddings are L2-normalized); fixed at creation, so use REBUILD=1 to change
+HNSW_META = {"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:construction_ef": 128, "hnsw:search_ef": 80}
 REBUILD   = os.getenv("REBUILD", "false").lower() in ("1", "true", "yes")
 
 # Fail fast on missing vars
@@ -35,98 +46,208 @@ if "/wiki" not in CONF_URL:
     raise SystemExit("[error] CONF_URL must include '/wiki', e.g. https://<site>.atlassian.net/wiki")
 
 # ========= Clients =========
-confluence = Confluence(url=CONF_URL, username=CONF_USER, password=CONF_TOKEN, cloud=True)
-embedder   = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-client     = chromadb.PersistentClient(path=CHROMA_PATH)
-
-if REBUILD:
-    try:
-        client.delete_collection(COLLECTION)
-        print(f"[info] Rebuilt collection: {COLLECTION}")
-    except Exception:
-        pass
-
-collection = client.get_or_create_collection(COLLECTION)
+# Encoder and Chroma are opened in main() so pool workers don't load them on import.
+def open_collection():
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
+    if REBUILD:
+        try:
+            client.delete_collection(COLLECTION)
+            print(f"[info] Rebuilt collection: {COLLECTION}")
+        except Exception:
+            pass
+    return client, client.get_or_create_collection(name=COLLECTION, metadata=HNSW_META)
 
 # ========= Helpers =========
-def fetch_pages(space_key: str, expand: str, page_limit: int = 500) -> List[dict]:
-    """Paginate through all content in a space; filter pages locally (API may not support 'type=' kw)."""
-    pages: List[dict] = []
-    start = 0
-    while True:
-        batch = confluence.get_all_pages_from_space(
-            space=space_key,
-            start=start,
-            limit=page_limit,
-            status=None,
-            expand=expand,
-        ) or []
-        # Some server/DC versions may return mixed content; keep only pages
-        batch = [b for b in batch if (b.get("type") or "page") == "page"]
-        pages.extend(batch)
-        print(f"[fetch] got {len(batch)} (total {len(pages)}) start={start}")
-        if len(batch) < page_limit:
-            break
-        start += page_limit
-        time.sleep(0.15)
+async def _fetch_pages(space_key: str, expand: str, page_limit: int, concurrency: int) -> List[dict]:
+    sem = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(auth=(CONF_USER, CONF_TOKEN), http2=True, timeout=60) as c:
+        async def window(start: int) -> dict:
+            async with sem:
+                r = await c.get(f"{CONF_URL}/rest/api/content", params={
+                    "spaceKey": space_key, "type": "page", "start": start,
+                    "limit": page_limit, "expand": expand,
+                })
+                r.raise_for_status()
+                return r.json()
+
+        pages: List[dict] = []
+        start, more = 0, True
+        step = page_limit
+        while more:
+            # First round is a single request; after that the server's effective limit is known
+            starts = [start] if start == 0 else [start + k * step for k in range(concurrency)]
+            for s, data in zip(starts, await asyncio.gather(*(window(s) for s in starts))):
+                links = data.get("_links", {})
+                for b in data.get("results", []):
+                    # Some server/DC versions may return mixed content; keep only pages
+                    if (b.get("type") or "page") == "page":
+                        b.setdefault("_links", {}).setdefault("base", links.get("base"))
+                        pages.append(b)
+                print(f"[fetch] got {data.get('size', 0)} (total {len(pages)}) start={s}")
+                if "next" not in links:
+                    more = False
+                    break
+            step = data.get("limit") or step  # Cloud may cap below the requested limit
+            start = starts[-1] + step
     return pages
 
+def fetch_pages(space_key: str, expand: str, page_limit: int = 500,
+                concurrency: int = FETCH_CONCURRENCY) -> List[dict]:
+    """Fetch every page in a space, requesting up to `concurrency` windows at once.
+
+    Pagination ends at the first window without a `next` link.
+    """
+    return asyncio.run(_fetch_pages(space_key, expand, page_limit, concurrency))
+
+# Tags/classes dropped entirely, and Confluence macro wrappers unwrapped (inner text/code kept)
+_KILL_TAGS = frozenset({"script", "style", "nav", "footer"})
+_KILL_DIV_CLASSES = frozenset({"expand-container", "comment", "ia-secondary-navigation", "ia-fixed-sidebar"})
+_UNWRAP_TAGS = ["ac:structured-macro", "ac:parameter", "ac:layout", "ac:layout-section",
+                "ac:layout-cell", "ri:attachment", "ri:page", "ri:user"]
+_MD = MarkdownConverter(heading_style="ATX", strip=["a"])
+
+def _is_noise(t) -> bool:
+    return t.name in _KILL_TAGS or (t.name == "div" and not _KILL_DIV_CLASSES.isdisjoint(t.get("class") or ()))
+
 def clean_confluence_html(html: str) -> str:
     """Remove common boilerplate/macros, convert to markdown, normalize whitespace."""
-    soup = BeautifulSoup(html or "", "html.parser")
-
-    # Remove obvious noise
-    for tag in soup.find_all(["script", "style", "nav", "footer"]):
-        tag.decompose()
+    soup = BeautifulSoup(html or "", "lxml")
 
-    for sel in ["div.expand-container", "div.comment", "div.ia-secondary-navigation", "div.ia-fixed-sidebar"]:
-        for t in soup.select(sel):
+    # Remove obvious noise (one tree walk)
+    for t in soup.find_all(_is_noise):
+        if not t.decomposed:  # may sit inside an already-removed ancestor
             t.decompose()
 
-    # Unwrap macro wrappers (keep inner text/code)
-    for t in soup.find_all(["ac:structured-macro", "ac:parameter", "ac:layout", "ac:layout-section",
-                            "ac:layout-cell", "ri:attachment", "ri:page", "ri:user"]):
+    for t in soup.find_all(_UNWRAP_TAGS):
         t.unwrap()
 
-    markdown = md(str(soup), heading_style="ATX", strip=["a"])
+    markdown = _MD.convert_soup(soup)
     markdown = re.sub(r"[ \t]+\n", "\n", markdown)
     markdown = re.sub(r"\n{3,}", "\n\n", markdown).strip()
     return markdown
 
+# Headings are their own paragraph; blank lines separate paragraphs
+_SPLIT_RE = re.compile(r"(?m)(?:^#{1,6} .*$)|(?:\n\s*\n)")
+
 def smart_chunks(text: str, max_chars: int = MAX_CHARS, overlap: int = OVERLAP) -> Iterable[str]:
-    """Paragraph/heading-aware chunking with overlap carry."""
+    """Paragraph/heading-aware chunking with overlap carry; chunks are slices of `text`."""
     if not text:
         return
-    parts = re.split(r"(^#{1,6} .*$)|(\n\s*\n)", text, flags=re.MULTILINE)
-    paras = [p for p in parts if p and not p.isspace()]
-    buf: List[str] = []
-    size = 0
-    for p in paras:
-        p = p.strip()
-        if not p:
-            continue
-        if size + len(p) + 1 > max_chars and buf:
-            chunk = "\n".join(buf).strip()
-            yield chunk
-            carry = chunk[-overlap:] if overlap > 0 else ""
-            buf = [carry, p] if carry else [p]
-            size = len(carry) + len(p)
+    # One forward scan; each match bounds the paragraph before it and is itself a
+    # paragraph (headings) or whitespace that trims to nothing (blank lines).
+    offsets = [0]
+    for m in _SPLIT_RE.finditer(text):
+        offsets += (m.start(), m.end())
+    offsets.append(len(text))
+    # Trimmed paragraph bounds: a stripped paragraph starts at the first occurrence of its
+    # first character in the segment, since everything before it is whitespace
+    starts: List[int] = []
+    ends: List[int] = []
+    for a, b in zip(offsets, offsets[1:]):
+        seg = text[a:b]
+        p = seg.strip()
+        if p:
+            a += seg.index(p[0])
+            starts.append(a)
+            ends.append(a + len(p))
+    if not starts:
+        return
+
+    # Each chunk is text[begin:end]; the overlap carry is just an earlier `begin` for the next
+    # chunk, moved past whitespace so chunks never start blank.
+    begin, i, n = starts[0], 0, len(starts)
+    while True:
+        j = i + 1  # a chunk always takes its first paragraph
+        while j < n and ends[j] - begin <= max_chars:
+            j += 1
+        if j == n:
+            break
+        end = ends[j - 1]
+        yield text[begin:end]
+        if overlap > 0:
+            begin = max(begin, end - overlap)
+            while text[begin].isspace():
+                begin += 1
         else:
-            buf.append(p)
-            size += len(p) + 1
-    if buf:
-        yield "\n".join(buf).strip()
+            begin = starts[j]
+        i = j
+    yield text[begin:ends[-1]]
 
 def sha1(text: str) -> str:
-    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+    # BLAKE3 truncated to SHA-1's 20 bytes; name kept so callers and cache keys read the same
+    return blake3(text.encode("utf-8")).hexdigest(length=20)
+
+def emb_cache_table(model_path: str) -> str:
+    """One table per model file, so FP32 and INT8 vectors never mix (e.g. emb_cache_minilm_int8)."""
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return "emb_cache_" + re.sub(r"\W", "_", name)
+
+def open_emb_cache(path: str, table: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (hash TEXT PRIMARY KEY, vec BLOB)")
+    return conn
+
+def load_cached_embeddings(conn: sqlite3.Connection, table: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+    """Bulk-load cached vectors; queried in slices to stay under SQLite's bound-variable limit."""
+    hits: Dict[str, np.ndarray] = {}
+    for i in range(0, len(hashes), 900):
+        part = hashes[i:i + 900]
+        rows = conn.execute(
+            f"SELECT hash, vec FROM {table} WHERE hash IN ({','.join('?' * len(part))})", part
+        )
+        for h, blob in rows:
+            hits[h] = np.frombuffer(blob, dtype=np.float32)
+    return hits
+
+def store_embeddings(conn: sqlite3.Connection, table: str, hashes: List[str], vecs: np.ndarray) -> None:
+    conn.executemany(
+        f"INSERT OR REPLACE INTO {table} (hash, vec) VALUES (?, ?)",
+        [(h, v.astype(np.float32).tobytes()) for h, v in zip(hashes, vecs)],
+    )
+    conn.commit()
 
 def page_url_from(p: dict) -> str:
     base = p.get("_links", {}).get("base")
     webui = p.get("_links", {}).get("webui")
     return base + webui if base and webui else f"{CONF_URL}/spaces/{SPACE_KEY}/pages/{p.get('id')}"
 
+def _clean_and_chunk(p: dict) -> List[Tuple[str, str, str, dict]]:
+    """Clean and chunk one page → [(key, id, doc, meta)], deduped within the page."""
+    page_id = p.get("id")
+    title   = p.get("title") or "Untitled"
+    html    = p.get("body", {}).get("view", {}).get("value", "")
+    updated = p.get("version", {}).get("when")
+    url     = page_url_from(p)
+
+    text = clean_confluence_html(html)
+    if not text:
+        return []
+
+    prefix = f"# {title}\n"
+    local_seen = set()
+    out = []
+
+    for j, ck in enumerate(smart_chunks(text)):
+        ck_full = (prefix + ck).strip()
+        key = sha1(f"{page_id}:{ck_full}")
+        if key in local_seen:
+            continue
+        local_seen.add(key)
+
+        out.append((key, f"{page_id}_{j}", ck_full, {
+            "space": SPACE_KEY,
+            "page_id": page_id,
+            "title": title,
+            "url": url,
+            "updated": updated,
+            "visibility": "company",
+            # Preformatted context block so /ask concatenates instead of re-formatting
+            "block": f"Title: {title}\nURL: {url}\nContent:\n{ck_full}\n---\n",
+        }))
+    return out
+
 # ========= Ingest =========
-def main():
+def main(workers: int = 1):
     print(f"[info] Indexing space={SPACE_KEY} → collection={COLLECTION} at {CHROMA_PATH}")
 
     pages = fetch_pages(
@@ -140,58 +261,72 @@ def main():
     ids:   List[str] = []
     docs:  List[str] = []
     metas: List[dict] = []
+    hashes: List[str] = []
     seen  = set()  # global dedup across all chunks
 
-    for idx, p in enumerate(pages, start=1):
-        page_id = p.get("id")
-        title   = p.get("title") or "Untitled"
-        html    = p.get("body", {}).get("view", {}).get("value", "")
-        updated = p.get("version", {}).get("when")
-        url     = page_url_from(p)
-
-        text = clean_confluence_html(html)
-        if not text:
-            continue
+    pool = Pool(workers) if workers > 1 else None
+    results = pool.imap_unordered(_clean_and_chunk, pages, chunksize=8) if pool else map(_clean_and_chunk, pages)
 
-        prefix = f"# {title}\n"
-        local_seen = set()
-
-        for j, ck in enumerate(smart_chunks(text)):
-            ck_full = (prefix + ck).strip()
-            key = sha1(f"{page_id}:{ck_full}")
-            if key in local_seen or key in seen:
+    for idx, chunks in enumerate(results, start=1):
+        for key, cid, doc, meta in chunks:
+            if key in seen:
                 continue
-            local_seen.add(key); seen.add(key)
-
-            ids.append(f"{page_id}_{j}")
-            docs.append(ck_full)
-            metas.append({
-                "space": SPACE_KEY,
-                "page_id": page_id,
-                "title": title,
-                "url": url,
-                "updated": updated,
-                "visibility": "company",
-            })
+            seen.add(key)
+            hashes.append(key)
+            ids.append(cid)
+            docs.append(doc)
+            metas.append(meta)
 
         if idx % 10 == 0:
             print(f"[build] processed {idx}/{len(pages)} pages")
 
+    if pool:
+        pool.close()
+        pool.join()
+
     if not docs:
         raise SystemExit("[warn] No chunks built; aborting before embeddings.")
 
-    # Embed in batches
-    embeddings: List[List[float]] = []
-    for i in range(0, len(docs), BATCH_EMB):
-        batch = docs[i:i + BATCH_EMB]
-        embs = embedder.encode(batch, normalize_embeddings=True)
-        embeddings.extend(embs)
+    encoder = load_encoder()
+    client, collection = open_collection()
+
+    # Reuse cached vectors for unchanged chunks; only misses go through the encoder
+    out = np.empty((len(docs), encoder.dim), dtype=np.float32)
+    table = emb_cache_table(encoder.path)
+    cache = open_emb_cache(EMB_CACHE, table)
+    cached = load_cached_embeddings(cache, table, hashes)
+    miss_idx: List[int] = []
+    for i, h in enumerate(hashes):
+        vec = cached.get(h)
+        if vec is None:
+            miss_idx.append(i)
+        else:
+            out[i] = vec
+    print(f"[embed] cache hits {len(docs) - len(miss_idx)}/{len(docs)}")
+
+    # Embed misses in length-sorted batches so each batch pads to a similar length
+    lengths = [len(encoder.tokenizer.tokenize(docs[i])) for i in miss_idx]
+    order = np.asarray(miss_idx, dtype=np.int64)[np.argsort(lengths, kind="stable")]
+    for i in range(0, len(order), BATCH_EMB):
+        idx = order[i:i + BATCH_EMB]
+        embs = encoder.encode([docs[k] for k in idx], batch_size=BATCH_EMB)
+        # Round to FP16-representable values; Chroma's ABI stays FP32
+        out[idx] = embs.astype(np.float16).astype(np.float32)
         if (i // BATCH_EMB) % 10 == 0:
-            print(f"[embed] {i + len(batch)}/{len(docs)}")
+            print(f"[embed] {i + len(idx)}/{len(order)}")
+
+    store_embeddings(cache, table, [hashes[i] for i in miss_idx], out[miss_idx])
+    cache.close()
 
-    # Upsert to Chroma
-    collection.upsert(documents=docs, ids=ids, metadatas=metas, embeddings=embeddings)
+    # Upsert to Chroma in bounded batches; the ndarray is passed as-is (no list-of-floats copy)
+    step = min(UPSERT_BATCH, client.get_max_batch_size())
+    for i in range(0, len(docs), step):
+        collection.upsert(documents=docs[i:i + step], ids=ids[i:i + step],
+                          metadatas=metas[i:i + step], embeddings=out[i:i + step])
     print(f"[done] Indexed {len(docs)} chunks from {len(pages)} pages into '{COLLECTION}'.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Index a Confluence space into Chroma.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes for HTML cleaning/chunking; 1 = serial")
+    main(workers=max(1, parser.parse_args().workers))